@@ -1,10 +1,11 @@
 from flask import Flask, request, jsonify, render_template_string
 from prometheus_client import Counter, Summary, generate_latest, CONTENT_TYPE_LATEST
 from pymongo import MongoClient
+from pymongo.write_concern import WriteConcern
 import os
 import time
 import random
-from datetime import datetime
+from datetime import datetime, timezone
 from bson import ObjectId
 
 app = Flask(__name__)
@@ -15,6 +16,8 @@ client = MongoClient(mongo_uri)
 db = client["filesure"]
 collection = db["jobs"]
 docs_collection = db["documents"]
+# Job events only wake workers (the job itself is in "jobs"), so skip the journal wait
+events_collection = db["job_events"].with_options(write_concern=WriteConcern(w=1, j=False))
 
 # Ensure database and collections exist
 try:
@@ -34,6 +37,12 @@ except Exception as e:
     # Collections might already exist, which is fine
     print(f"Collections setup: {e}")
 
+# Capped event log that workers tail to pick up new jobs without polling
+try:
+    db.create_collection("job_events", capped=True, size=1 << 20)
+except Exception as e:
+    print(f"Job events setup: {e}")
+
 # Prometheus metrics
 REQUEST_COUNT = Counter('requests_total', 'Total number of requests')
 REQUEST_FAILS = Counter('db_write_failures', 'Number of DB write failures')
@@ -287,7 +296,7 @@ def submit():
         return jsonify({"error": "num_jobs must be a valid integer"}), 400
     
     try:
-        current_time = datetime.utcnow()
+        current_time = datetime.now(timezone.utc)
         created_jobs = []
         
         # Create multiple job documents
@@ -310,13 +319,20 @@ def submit():
             }
             
                     # Track MongoDB operation time
-        start_time = time.time()
+        start_time = time.monotonic()
         result = collection.insert_one(job_doc)
-        mongo_time = time.time() - start_time
+        mongo_time = time.monotonic() - start_time
         
         MONGODB_OPERATIONS.labels(operation='insert_one').inc()
         MONGODB_OPERATION_TIME.labels(operation='insert_one').observe(mongo_time)
         
+        # Wake up workers tailing the job_events collection. The job is already
+        # saved and workers drain pending jobs on startup, so don't fail the request
+        try:
+            events_collection.insert_one({"jobId": result.inserted_id, "ts": current_time})
+        except Exception as e:
+            print(f"Job event for {result.inserted_id} not recorded: {e}")
+        
         created_jobs.append({
             "jobId": str(result.inserted_id),
             "cin": job_doc["cin"],
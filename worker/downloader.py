@@ -1,9 +1,14 @@
+import json
 import os
+import socket
 import sys
-from datetime import datetime
-from pymongo import MongoClient
+import time
+from datetime import datetime, timedelta, timezone
+from pymongo import MongoClient, CursorType
+from pymongo.errors import CollectionInvalid, PyMongoError
+from azure.core.pipeline.transport import RequestsTransport
 from azure.storage.blob import BlobServiceClient
-from prometheus_client import CollectorRegistry, Gauge, push_to_gateway
+from prometheus_client import CollectorRegistry, Gauge, push_to_gateway, start_http_server
 
 # ----------------------
 # Load environment
@@ -12,6 +17,14 @@ MONGO_URI = os.getenv("MONGO_URI")
 AZURE_BLOB_CONN = os.getenv("AZURE_BLOB_CONN")
 AZURE_CONTAINER = os.getenv("AZURE_CONTAINER")
 PUSHGATEWAY_URL = os.getenv("PUSHGATEWAY_URL", "http://pushgateway:9091")
+# Exit after this many seconds without a new job event (lets KEDA scale down)
+IDLE_TIMEOUT = int(os.getenv("WORKER_IDLE_TIMEOUT", "60"))
+PROMETHEUS_METRICS = os.getenv("PROMETHEUS_METRICS", "false").lower() == "true"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+# An in_progress job whose lock is older than this is assumed abandoned and reclaimed
+JOB_LOCK_LEASE = timedelta(seconds=int(os.getenv("JOB_LOCK_LEASE_SECONDS", "300")))
+# Computed once; identifies this process in job locks and metric groups
+WORKER_ID = f"worker-{os.getpid()}-{int(time.time())}-{socket.gethostname()}"
 
 if not all([MONGO_URI, AZURE_BLOB_CONN, AZURE_CONTAINER]):
     print("❌ Missing required environment variables.", flush=True)
@@ -20,12 +33,47 @@ if not all([MONGO_URI, AZURE_BLOB_CONN, AZURE_CONTAINER]):
 # ----------------------
 # Setup Mongo & Blob
 # ----------------------
-client = MongoClient(MONGO_URI)
+# Jobs are processed one at a time, so a small pool kept warm is enough;
+# PyMongo 4 always enables TCP keepalive on its sockets
+client = MongoClient(
+    MONGO_URI,
+    maxPoolSize=4,
+    minPoolSize=1,
+    socketTimeoutMS=10000,
+    connectTimeoutMS=5000,
+    serverSelectionTimeoutMS=5000,
+    retryWrites=True,
+    appname="filesure-worker"
+)
 db = client["filesure"]
 jobs_collection = db["jobs"]
 docs_collection = db["documents"]
 
-blob_service_client = BlobServiceClient.from_connection_string(AZURE_BLOB_CONN)
+# Capped collection the API appends to on every enqueue; tailed by workers
+try:
+    db.create_collection("job_events", capped=True, size=1 << 20)
+except CollectionInvalid:
+    pass  # already exists
+events_collection = db["job_events"]
+
+# Back both claim branches (pending, expired in_progress lease) with an index
+# so claims don't scan the whole queue
+try:
+    jobs_collection.create_index(
+        [("jobStatus", 1), ("lockedAt", 1)],
+        name="claim_idx"
+    )
+    docs_collection.create_index("jobId")
+except PyMongoError as e:
+    print(f"Index setup: {e}", flush=True)
+
+blob_transport = RequestsTransport(connection_timeout=10, read_timeout=30)
+
+blob_service_client = BlobServiceClient.from_connection_string(
+    AZURE_BLOB_CONN,
+    transport=blob_transport,
+    max_single_put_size=4 * 1024 * 1024  # job bundles always take the single-PUT path
+)
 container_client = blob_service_client.get_container_client(AZURE_CONTAINER)
 
 # Ensure container exists
@@ -42,23 +90,77 @@ g_completed = Gauge("completed_jobs", "Number of successfully completed jobs", r
 g_failed = Gauge("failed_jobs", "Number of failed jobs", registry=registry)
 g_docs_uploaded = Gauge("documents_uploaded_total", "Number of documents uploaded to Azure Blob", registry=registry)
 g_blob_failures = Gauge("blob_upload_failures_total", "Number of blob upload failures", registry=registry)
+g_job_duration = Gauge("job_duration_seconds", "Time taken to process the last job", registry=registry)
 
-def push_metrics(completed=0, failed=0, uploaded=0, blob_failed=0):
-    g_completed.set(completed)
-    g_failed.set(failed)
-    g_docs_uploaded.set(uploaded)
-    g_blob_failures.set(blob_failed)
-    push_to_gateway(PUSHGATEWAY_URL, job="filesure-worker", registry=registry)
+def push_metrics(completed=0, failed=0, uploaded=0, blob_failed=0, duration=0):
+    # A worker now handles many jobs, so accumulate per process and push under
+    # a per-process group instead of overwriting one shared group per job
+    g_completed.inc(completed)
+    g_failed.inc(failed)
+    g_docs_uploaded.inc(uploaded)
+    g_blob_failures.inc(blob_failed)
+    g_job_duration.set(duration)
+    push_to_gateway(PUSHGATEWAY_URL, job="filesure-worker",
+                    grouping_key={"worker": WORKER_ID}, registry=registry)
 
 # ----------------------
 # Job Processing
 # ----------------------
+def upload_bundle(job, documents):
+    """Upload all of a job's documents as one NDJSON blob.
+
+    Returns one metadata record per document, locating it in the bundle by
+    byte offset and length.
+    """
+    job_id = str(job["_id"])
+    # Upload to Azure Blob under path documents/<jobId>/documents.ndjson
+    blob_name = f"documents/{job_id}/documents.ndjson"
+    lines = [json.dumps(doc).encode() + b"\n" for doc in documents]
+    payload = b"".join(lines)
+
+    blob_client = container_client.get_blob_client(blob_name)
+
+    try:
+        # Known length lets the SDK send the bytes as-is in one PUT
+        blob_client.upload_blob(payload, length=len(payload), overwrite=True)
+
+    except Exception as e:
+        print(f"❌ Failed to upload {blob_name}: {e}", flush=True)
+        now = datetime.now(timezone.utc)
+        return [{
+            "jobId": job["_id"],
+            "filename": doc["filename"],
+            "blobPath": None,
+            "uploadStatus": "failed",
+            "error": str(e),
+            "uploadedAt": now
+        } for doc in documents]
+
+    print(f"✅ Uploaded {len(documents)} documents to {blob_name}", flush=True)
+    now = datetime.now(timezone.utc)
+    metadata_docs = []
+    offset = 0
+    for doc, line in zip(documents, lines):
+        metadata_docs.append({
+            "jobId": job["_id"],
+            "filename": doc["filename"],
+            "blobPath": blob_name,
+            "byteOffset": offset,
+            "byteLength": len(line),
+            "uploadStatus": "success",
+            "uploadedAt": now
+        })
+        offset += len(line)
+    return metadata_docs
+
 def process_job(job):
     job_id = str(job["_id"])
     print(f"⚙️ Processing job {job_id} for {job.get('companyName')}", flush=True)
+    started = time.monotonic()
 
     uploaded_count = 0
     failed_count = 0
+    job_crashed = False
 
     try:
         # Simulated list of "documents" (in reality you’d fetch from external API or disk)
@@ -67,78 +169,155 @@ def process_job(job):
             {"filename": f"{job_id}_doc2.txt", "content": f"Dummy content for job {job_id} - doc2"}
         ]
 
-        for doc in documents:
-            try:
-                # Upload to Azure Blob under path documents/<jobId>/<filename>
-                blob_name = f"documents/{job_id}/{doc['filename']}"
-                blob_client = container_client.get_blob_client(blob_name)
-                blob_client.upload_blob(doc["content"], overwrite=True)
-
-                # Insert into Mongo "documents" collection
-                docs_collection.insert_one({
-                    "jobId": job["_id"],
-                    "filename": doc["filename"],
-                    "blobPath": blob_name,
-                    "uploadStatus": "success",
-                    "uploadedAt": datetime.utcnow()
-                })
-
+        # Each document is tiny, so per-object overhead dominates; one PUT per job
+        metadata_docs = upload_bundle(job, documents)
+        for metadata in metadata_docs:
+            if metadata["uploadStatus"] == "success":
                 uploaded_count += 1
-                print(f"✅ Uploaded {doc['filename']} to {blob_name}", flush=True)
-
-            except Exception as e:
+            else:
                 failed_count += 1
-                print(f"❌ Failed to upload {doc['filename']}: {e}", flush=True)
-
-                docs_collection.insert_one({
-                    "jobId": job["_id"],
-                    "filename": doc["filename"],
-                    "blobPath": None,
-                    "uploadStatus": "failed",
-                    "error": str(e),
-                    "uploadedAt": datetime.utcnow()
-                })
-
-        # Update job status
-        job_status = "completed" if failed_count == 0 else "partial_failed"
-        jobs_collection.update_one(
-            {"_id": job["_id"]},
-            {"$set": {
-                "jobStatus": job_status,
-                "updatedAt": datetime.utcnow(),
-                "progress": 100,
-                "totalDocuments": len(documents),
-                "uploadedDocuments": uploaded_count,
-                "failedDocuments": failed_count
-            }}
-        )
 
-        # Push metrics
-        push_metrics(completed=(1 if failed_count == 0 else 0),
-                     failed=(1 if failed_count > 0 else 0),
-                     uploaded=uploaded_count,
-                     blob_failed=failed_count)
+        # The bundle uploads all-or-nothing, so there is no partial success
+        job_status = "completed" if failed_count == 0 else "failed"
+        job_update = {
+            "jobStatus": job_status,
+            "updatedAt": datetime.now(timezone.utc),
+            "progress": 100,
+            "totalDocuments": len(documents),
+            "uploadedDocuments": uploaded_count,
+            "failedDocuments": failed_count
+        }
+
+        # Insert into Mongo "documents" collection in one round-trip
+        try:
+            docs_collection.insert_many(metadata_docs, ordered=False,
+                                        bypass_document_validation=True)
+        except PyMongoError as e:
+            print(f"❌ Failed to save document metadata for job {job_id}: {e}", flush=True)
+            job_update.update({"jobStatus": "failed", "error": str(e)})
 
     except Exception as e:
         print(f"❌ Job {job_id} failed entirely: {e}", flush=True)
-        jobs_collection.update_one(
-            {"_id": job["_id"]},
-            {"$set": {"jobStatus": "failed", "updatedAt": datetime.utcnow()}}
-        )
-        push_metrics(failed=1, blob_failed=1)
+        job_crashed = True
+        job_update = {"jobStatus": "failed", "updatedAt": datetime.now(timezone.utc)}
+
+    # Single terminal write per job, whichever path we took; skipped if our
+    # lease expired and another worker has reclaimed the job
+    jobs_collection.update_one({"_id": job["_id"], "lockedBy": WORKER_ID}, {"$set": job_update})
+
+    # Push metrics
+    duration = time.monotonic() - started
+    try:
+        if job_crashed:
+            push_metrics(failed=1, blob_failed=1, duration=duration)
+        else:
+            # Upload counts stay accurate even if the metadata insert failed
+            completed = 1 if job_update["jobStatus"] == "completed" else 0
+            push_metrics(completed=completed,
+                         failed=1 - completed,
+                         uploaded=uploaded_count,
+                         blob_failed=failed_count,
+                         duration=duration)
+    except Exception as e:
+        print(f"⚠️ Failed to push metrics for job {job_id}: {e}", flush=True)
 
 # ----------------------
 # Main Worker Logic
 # ----------------------
-if __name__ == "__main__":
-    job = jobs_collection.find_one_and_update(
-        {"jobStatus": "pending"},
-        {"$set": {"jobStatus": "in_progress", "updatedAt": datetime.utcnow()}}
+def claim_job():
+    now = datetime.now(timezone.utc)
+    return jobs_collection.find_one_and_update(
+        {"$or": [
+            {"jobStatus": "pending"},
+            # Reclaim jobs whose worker died or lost Mongo before finishing
+            {"jobStatus": "in_progress", "lockedAt": {"$lt": now - JOB_LOCK_LEASE}}
+        ]},
+        {"$set": {
+            "jobStatus": "in_progress",
+            "lockedBy": WORKER_ID,
+            "lockedAt": now,
+            "updatedAt": now
+        }},
+        # Only these fields are read while processing; skip the rest on the wire
+        projection={"_id": 1, "companyName": 1, "cin": 1}
     )
 
-    if not job:
-        print("ℹ️ No pending jobs found, exiting.", flush=True)
-        sys.exit(0)
+def fail_job(job, error):
+    try:
+        jobs_collection.update_one(
+            {"_id": job["_id"], "lockedBy": WORKER_ID},
+            {"$set": {
+                "jobStatus": "failed",
+                "error": str(error),
+                "updatedAt": datetime.now(timezone.utc)
+            }}
+        )
+    except PyMongoError as e:
+        print(f"⚠️ Could not mark job {job['_id']} failed, leaving it for lease expiry: {e}", flush=True)
+
+    try:
+        push_metrics(failed=1)
+    except Exception as e:
+        print(f"⚠️ Failed to push metrics for job {job['_id']}: {e}", flush=True)
+
+def drain_jobs():
+    processed = 0
+    while (job := claim_job()):
+        try:
+            process_job(job)
+        except PyMongoError as e:
+            # The terminal write didn't land; don't leave the job in_progress
+            print(f"❌ Job {job['_id']} could not be finalised: {e}", flush=True)
+            fail_job(job, e)
+        processed += 1
+    return processed
+
+def latest_event_id():
+    latest = events_collection.find_one(sort=[("$natural", -1)])
+    return latest["_id"] if latest else None
+
+def run():
+    # Mark the end of the event log *before* draining, so an event for a job
+    # enqueued mid-drain is still tailed rather than skipped as already seen.
+    # No position is persisted: the startup drain covers anything a previous
+    # worker left pending.
+    last_event_id = latest_event_id()
+    drain_jobs()
+
+    last_activity = time.monotonic()
+
+    while time.monotonic() - last_activity < IDLE_TIMEOUT:
+        query = {"_id": {"$gt": last_event_id}} if last_event_id else {}
+        cursor = (events_collection
+                  .find(query, cursor_type=CursorType.TAILABLE_AWAIT)
+                  .max_await_time_ms(1000)
+                  .batch_size(100))
 
-    process_job(job)
+        try:
+            while cursor.alive and time.monotonic() - last_activity < IDLE_TIMEOUT:
+                try:
+                    event = cursor.next()
+                except StopIteration:
+                    continue  # awaitData timed out with no new events
+
+                last_event_id = event["_id"]
+                if drain_jobs():
+                    last_activity = time.monotonic()
+
+        except PyMongoError as e:
+            # Cursor or claim errors (e.g. AutoReconnect, CappedPositionLost);
+            # per-job errors are handled in drain_jobs. Reopen rather than die
+            print(f"⚠️ Job event tail interrupted, reopening cursor: {e}", flush=True)
+
+        # Cursor dies on an empty capped collection or an error; back off before reopening
+        cursor.close()
+        time.sleep(1)
+
+    print(f"ℹ️ No job events for {IDLE_TIMEOUT}s, exiting.", flush=True)
+
+if __name__ == "__main__":
+    if PROMETHEUS_METRICS:
+        # Also expose the registry for direct scrapes while the worker is alive
+        start_http_server(METRICS_PORT, registry=registry)
+    run()
     sys.exit(0)